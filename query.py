@@ -9,18 +9,100 @@ https://github.com/mfouesneau/ezpadova
 
 
 import sys
+import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.filepost import encode_multipart_formdata
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 import zlib
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
-from os.path import join, exists
+from os.path import join, exists, getsize
 import configparser
 from pathlib import Path
-from os import makedirs
+from os import makedirs, remove, replace
 
 webserver = 'http://stev.oapd.inaf.it'
 
+# Maximum number of simultaneous queries to the CMD service.
+max_workers = 8
+
+# Chunk size for streaming downloads; 128 kB chunks keep the per-read
+# overhead low without holding much of the payload in flight.
+READ_BUFFER_SIZE = 128 * 1024
+
+# Shared session so that all queries reuse the same pooled connections,
+# instead of paying a new TCP handshake per request.
+_SESSION = requests.Session()
+
+# Cache identical sub-requests (and 304 revalidations) when the optional
+# 'cachecontrol' package is installed. Its adapter subclasses HTTPAdapter,
+# so the pool sizing and retry policy are the same either way.
+_adapter_args = dict(
+    pool_connections=max_workers, pool_maxsize=max_workers,
+    max_retries=Retry(total=3, backoff_factor=0.5))
+try:
+    from cachecontrol import CacheControlAdapter
+    _SESSION.mount('http://', CacheControlAdapter(**_adapter_args))
+except ImportError:
+    _SESSION.mount('http://', HTTPAdapter(**_adapter_args))
+
+# Avoid interleaved progress messages from the download threads.
+_PRINT_LOCK = threading.Lock()
+
+# Name of the output file generated by the service, as it shows up in the
+# HTML response. Compiled once here instead of on every query.
+_OUTPUT_RE = re.compile(r'output\d+')
+
+# Filters / lambdas / omegas table rows in the HTML response, consumed by
+# filterLambaOmega(). Compiled once here.
+_FILTER_RE = re.compile(r'Filter.*<th>&lambda')
+_LAMBDA_RE = re.compile(r'lambda.*omega')
+_OMEGA_RE = re.compile(r'omega.*lambda')
+
+# Start of each age block in the downloaded isochrones.
+_ZINI_RE = re.compile(rb'^# Zini', re.MULTILINE)
+
+# Leading magic bytes of a gzip stream.
+_GZ_MAGIC = b"\x1f\x8b\x08"
+
+# Data lines whose 10th column (the 'label' field) equals 9. Addresses #2
+_LABEL9_RE = re.compile(
+    rb'^[ \t]*(?:\S+[ \t]+){9}9(?=[ \t\r\n]|$).*\n?', re.MULTILINE)
+
+# Fixed multipart boundary, so that the constant part of the form body can
+# be encoded once per run and shared by every query.
+_FORM_BOUNDARY = uuid.uuid4().hex
+_FORM_CLOSING = ('--%s--\r\n' % _FORM_BOUNDARY).encode('ascii')
+_FORM_CONTENT_TYPE = 'multipart/form-data; boundary=%s' % _FORM_BOUNDARY
+
+
+def encodeForm(fields):
+    """
+    Encode 'fields' as a multipart/form-data body using the fixed boundary.
+    """
+    body, _ = encode_multipart_formdata(fields, boundary=_FORM_BOUNDARY)
+    return body
+
+# Use libdeflate for gzip decompression when available; its inflate is
+# noticeably faster than zlib's. The server sends the whole gzip payload in
+# a single response, so the whole-buffer API fits with no streaming caveats.
+try:
+    import libdeflate
+
+    _HAVE_LIBDEFLATE = True
+
+    def _gunzip(buf):
+        return libdeflate.gzip_decompress(buf)
+except ImportError:
+    _HAVE_LIBDEFLATE = False
+
+    def _gunzip(buf):
+        return zlib.decompress(buf, 15 + 32)
+
 # Available sets of tracks (PARSEC + COLIBRI).
 map_models = {
     'PARSEC': {
@@ -92,21 +174,19 @@ def main():
         systemsList()
         return
 
-    # Ages to add to the files.
-    ages = np.arange(*map(float, a_range))
-    # Add the largest value if it is not included
-    if not np.isclose(ages[-1], float(a_range[1])):
-        ages = np.append(ages, float(a_range[1]))
+    # Ages to add to the files, with the log-to-linear conversion applied
+    # in place.
+    ages = _age_grid(*map(float, a_range))
     if age_sel == 'log':
-        ages = 10. ** ages
+        np.power(10., ages, out=ages)
 
     # Sub-folder where isochrone files will be stored. Notice the lower-case
     sub_folder = phot_syst.lower() + '/'
 
-    # If the sub-folder doesn't exist, create it before moving the file.
-    full_path = 'isochrones/' + sub_folder
-    if not exists(full_path):
-        makedirs(full_path)
+    # Create the sub-folder (if needed) before moving the file. 'exist_ok'
+    # avoids a separate exists() check and the race between the two calls.
+    full_path = join('isochrones', sub_folder)
+    makedirs(full_path, exist_ok=True)
 
     print('\nQuery CMD using: {} + COLIBRI {}.'.format(
         PARSEC, COLIBRI))
@@ -115,64 +195,104 @@ def main():
     track_colibri = map_models['COLIBRI'][COLIBRI]
     evol_track = PARSEC + '+C' + COLIBRI
 
-    # Update parameters in dictionary
-    __def_args__['output_gzip'] = (None, gz_flag)
-    __def_args__['track_parsec'] = (None, track_parsec)
-    __def_args__['track_omegai'] = (None, omegai)
-    __def_args__['track_colibri'] = (None, track_colibri)
+    # Update parameters in a run-local copy; the module-level defaults are
+    # left untouched so no shared state is mutated once the workers start.
+    base_args = dict(__def_args__)
+    base_args['output_gzip'] = (None, gz_flag)
+    base_args['track_parsec'] = (None, track_parsec)
+    base_args['track_omegai'] = (None, omegai)
+    base_args['track_colibri'] = (None, track_colibri)
 
     if age_sel == 'log':
-        __def_args__['isoc_lagelow'] = (None, a_range[0])
-        __def_args__['isoc_lageupp'] = (None, a_range[1])
-        __def_args__['isoc_dlage'] = (None, a_range[2])
+        base_args['isoc_lagelow'] = (None, a_range[0])
+        base_args['isoc_lageupp'] = (None, a_range[1])
+        base_args['isoc_dlage'] = (None, a_range[2])
     elif age_sel == 'linear':
-        __def_args__['isoc_isagelog'] = (None, "0")
-        __def_args__['isoc_agelow'] = (None, a_range[0])
-        __def_args__['isoc_ageupp'] = (None, a_range[1])
-        __def_args__['isoc_dage'] = (None, a_range[2])
+        base_args['isoc_isagelog'] = (None, "0")
+        base_args['isoc_agelow'] = (None, a_range[0])
+        base_args['isoc_ageupp'] = (None, a_range[1])
+        base_args['isoc_dage'] = (None, a_range[2])
 
     if met_sel == 'MH':
-        __def_args__['isoc_ismetlog'] = (None, "1")
+        base_args['isoc_ismetlog'] = (None, "1")
 
-    __def_args__['photsys_file'] = (
+    base_args['photsys_file'] = (
         None, '{}_{}.dat'.format(phot_syst_file, phot_syst))
-    __def_args__['photsys_version'] = (None, phot_syst_v)
-
-    # Run for given range in metallicity.
-    for i, metal in enumerate(m_range):
-
-        print('\nz = {} ({}/{})'.format(metal, i + 1, len(m_range)))
+    base_args['photsys_version'] = (None, phot_syst_v)
 
-        # Update metallicity parameter
-        par_dict = __def_args__.copy()
-        if met_sel == 'Z':
-            par_dict['isoc_zlow'] = (None, str(metal))
-        elif met_sel == 'MH':
-            par_dict['isoc_metlow'] = (None, str(metal))
+    # Serialize the ~25 unchanging form fields once; each query then only
+    # appends its own metallicity field to the pre-encoded body instead of
+    # re-serializing the full multipart boilerplate.
+    body_prefix = encodeForm(base_args)[:-len(_FORM_CLOSING)]
 
-        # Query the service
-        data, c = __query_website(par_dict, phot_syst)
+    # File names follow the Z metallicity values; format all the stems in
+    # one vectorized sweep (MHtoZ operates on the full array directly).
+    metals_z = MHtoZ(m_range) if met_sel == 'MH' else m_range
+    file_stems = np.char.replace(np.char.mod('%0.10f', metals_z), '.', '_')
 
-        if i == 0:
-            filterLambaOmega(c, evol_track, full_path)
+    # The name of the metallicity field never changes across the loop.
+    metal_key = 'isoc_zlow' if met_sel == 'Z' else 'isoc_metlow'
 
-        # Add ages to each isochrone
-        data = addAge(data, ages, rm_label9)
-
-        if met_sel == 'MH':
-            metal = MHtoZ(metal)
+    # Build one request body per metallicity value. Metallicities whose
+    # file is already present (e.g., from an interrupted run) are skipped;
+    # the server-side isochrone generation is by far the dominant cost.
+    jobs = []
+    for metal, stem in zip(m_range, file_stems):
+        overrides = {metal_key: (None, str(metal))}
 
         # Define file name according to metallicity value.
-        file_name = join(full_path + ('%0.10f' % metal).replace('.', '_')
-                         + '.dat')
-
-        # Store in file.
-        with open(file_name, 'w') as f:
-            f.write(data)
+        file_name = join(full_path, stem + '.dat')
+        if exists(file_name) and getsize(file_name) > 0:
+            print('z = {}: file found, skipping'.format(metal))
+            continue
+
+        jobs.append((metal, file_name, body_prefix + encodeForm(overrides)))
+
+    # Query the service for all metallicities in parallel. Each query spends
+    # most of its time waiting on the server-side computation, so overlapping
+    # them cuts the total wall time down by (roughly) the number of workers.
+    if jobs:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) \
+                as exe:
+            # Only the first query holds on to its HTML response, for the
+            # one-shot filters/lambdas/omegas extraction below; the rest
+            # drop theirs as soon as the output name is parsed out.
+            futures = {
+                exe.submit(
+                    __query_website, body, phot_syst, file_name, ages,
+                    rm_label9, maybe_gz=bool(gz_flag),
+                    want_meta=(j == 0)): metal
+                for j, (metal, file_name, body) in enumerate(jobs)}
+
+            done = 0
+            for future in as_completed(futures):
+                metal = futures[future]
+                c = future.result()
+
+                done += 1
+                with _PRINT_LOCK:
+                    print('\nz = {} ({}/{})'.format(metal, done, len(jobs)))
+
+                if c is not None:
+                    filterLambaOmega(c, evol_track, full_path)
 
     print('\nAll done!')
 
 
+def _age_grid(lo, hi, step):
+    """
+    Age values from 'lo' up to and including 'hi', in steps of 'step'. The
+    endpoint is clamped rather than the spacing stretched: the server
+    builds its own grid from the same step, so the interior values must
+    stay exact multiples of it for the '# Age' comments to match the
+    isochrones they label.
+    """
+    n = int(round((hi - lo) / step)) + 1
+    ages = lo + step * np.arange(n)
+    ages[-1] = hi
+    return ages
+
+
 def MHtoZ(MH):
     """
     Transform the MH metallicity values to Z using the relation given
@@ -189,7 +309,7 @@ def MHtoZ(MH):
 def systemsList():
     """
     """
-    r = requests.get('http://stev.oapd.inaf.it/cgi-bin/cmd')
+    r = _SESSION.get(webserver + '/cgi-bin/cmd')
     soup = BeautifulSoup(r.content, "lxml")
     systs = soup.find_all("select")[0]
 
@@ -218,28 +338,48 @@ def systemsList():
     print("\nAll systems listed")
 
 
-def __query_website(d, phot_syst):
+def __query_website(body, phot_syst, file_name, ages, rm_label9,
+                    maybe_gz=True, want_meta=False):
     """
-    Communicate with the CMD website.
+    Communicate with the CMD website. 'body' is the pre-encoded multipart
+    form for this query. The downloaded isochrones are streamed through
+    addAge() straight into 'file_name'. The HTML response to the form
+    submission is returned only when 'want_meta' is set (it is identical
+    across queries, and only needed once); otherwise it is discarded so
+    the string can be collected right away.
     """
 
-    print('  Interrogating {0}...'.format(webserver))
-    c = requests.post(webserver + '/cgi-bin/cmd', files=d).text
-    aa = re.compile('output\d+')
-    fname = aa.findall(c)
-    if len(fname) > 0:
-
-        url = '{0}/tmp/{1}.dat'.format(webserver, fname[0])
-        print('  Downloading data...{0}'.format(url))
-        r = requests.get(url)
-
-        typ = gzipDetect(r.content)
-        if typ == "gz":
-            print("  Compressed 'gz' file detected")
-            rr = zlib.decompress(bytes(r.content), 15 + 32).decode('ascii')
-        else:
-            rr = r.text
-        return rr, c
+    with _PRINT_LOCK:
+        print('  Interrogating {0}...'.format(webserver))
+    resp = _SESSION.post(
+        webserver + '/cgi-bin/cmd', data=body,
+        headers={'Content-Type': _FORM_CONTENT_TYPE})
+    # The response is plain ASCII HTML; decoding it directly skips the
+    # charset auto-detection pass that Response.text can run on the body.
+    c = resp.content.decode('ascii', errors='replace')
+    fname = _outputName(c)
+    if fname is not None:
+
+        url = '{0}/tmp/{1}.dat'.format(webserver, fname)
+        with _PRINT_LOCK:
+            print('  Downloading data...{0}'.format(url))
+        r = _SESSION.get(url, stream=True)
+
+        # Write as we decompress: the file never exists as one big buffer
+        # in memory, and the disk writes overlap with the download. Stream
+        # into a temporary name and only move it into place once complete,
+        # so an interrupted download can never leave a truncated .dat
+        # behind for the resume check to then skip over.
+        part_name = file_name + '.part'
+        try:
+            with open(part_name, 'wb', buffering=1 << 20) as f:
+                addAge(_iter_payload(r, maybe_gz), ages, rm_label9, f)
+        except BaseException:
+            if exists(part_name):
+                remove(part_name)
+            raise
+        replace(part_name, file_name)
+        return c if want_meta else None
     else:
 
         error_msg = ("Photometric system {} still not available among YBC "
@@ -254,22 +394,80 @@ def __query_website(d, phot_syst):
             raise RuntimeError('FATAL: Server Response is incorrect')
 
 
+def _outputName(c):
+    """
+    Extract the name of the output file generated by the service from the
+    HTML response. The download anchor's href is read off the parsed
+    document; scanning the raw HTML is kept as a fallback in case the
+    page layout changes.
+    """
+    for a in BeautifulSoup(c, "lxml").find_all("a", href=True):
+        m = _OUTPUT_RE.search(a['href'])
+        if m is not None:
+            return m.group(0)
+
+    m = _OUTPUT_RE.search(c)
+    return m.group(0) if m is not None else None
+
+
+def _iter_payload(r, maybe_gz=True):
+    """
+    Yield the content of a streamed response as raw (ASCII) byte chunks,
+    gzip-decompressing on the fly when the magic bytes say so. The magic
+    bytes are always checked — 'maybe_gz' only says whether compression
+    was requested, and a compressed response is decompressed either way
+    rather than written out as binary garbage.
+    """
+    chunks = r.iter_content(chunk_size=READ_BUFFER_SIZE)
+    first = next(chunks, b'')
+    if gzipDetect(first):
+        with _PRINT_LOCK:
+            if maybe_gz:
+                print("  Compressed 'gz' file detected")
+            else:
+                print("  Warning: compressed 'gz' response to an "
+                      "uncompressed request")
+        if _HAVE_LIBDEFLATE:
+            # libdeflate only exposes a whole-buffer API
+            yield _gunzip(first + b''.join(chunks))
+        else:
+            # Feed the stream through zlib as it downloads, so the full
+            # compressed payload is never held in memory alongside the
+            # decompressed one.
+            dec = zlib.decompressobj(15 + 32)
+            yield dec.decompress(first)
+            for chunk in chunks:
+                yield dec.decompress(chunk)
+            yield dec.flush()
+    else:
+        yield first
+        for chunk in chunks:
+            yield chunk
+
+
 def filterLambaOmega(c, evol_track, full_path):
     """
     Extract filters, lambdas, and omegas data
     """
-    # Extract filters, lambdas, and omegas data
-    aa = re.compile('Filter.*<th>&lambda')
-    fname = aa.findall(c)
+    # Extract filters, lambdas, and omegas data. Only the first match of
+    # each pattern is used, so search() stops scanning as soon as it is
+    # found instead of collecting every match in a list.
+    def first_match(patt):
+        m = patt.search(c)
+        if m is None:
+            raise RuntimeError(
+                "Could not extract the '{}' data from the server "
+                "response".format(patt.pattern))
+        return m.group(0)
+
     # In CMD v3.2 apparently all filters have a 'mag' added.
     filters = [
-        _.split('</td>')[0] + 'mag' for _ in fname[0].split('<td>')][1:]
-    aa = re.compile('lambda.*omega')
-    fname = aa.findall(c)
-    lambdas = [_.split('</td>')[0] for _ in fname[0].split('<td>')][1:]
-    aa = re.compile('omega.*lambda')
-    fname = aa.findall(c)
-    omegas = [_.split('</td>')[0] for _ in fname[0].split('<td>')][1:]
+        _.split('</td>')[0] + 'mag'
+        for _ in first_match(_FILTER_RE).split('<td>')][1:]
+    lambdas = [
+        _.split('</td>')[0] for _ in first_match(_LAMBDA_RE).split('<td>')][1:]
+    omegas = [
+        _.split('</td>')[0] for _ in first_match(_OMEGA_RE).split('<td>')][1:]
 
     # Store in file.
     with open(full_path + "/filterslambdas.dat", 'w') as f:
@@ -278,48 +476,50 @@ def filterLambaOmega(c, evol_track, full_path):
 
 def gzipDetect(data):
     """
-    Detect potential compressed "gz" file.
+    Detect potential compressed "gz" file from its leading magic bytes.
     """
-    gzchars = b"\x1f\x8b\x08"
+    return data.startswith(_GZ_MAGIC)
 
-    if data[:len(gzchars)] == gzchars:
-        return "gz"
 
-    return None
-
-
-def addAge(data, ages, rm_label9):
+def addAge(chunks, ages, rm_label9, fout):
     """
     The new format in CMD v3.2 does not include the commented line with the
     'Age' value, and the logAge column is rounded to 3 decimal places so
     this value can not be taken from there.
 
-    Add this line back to each age for each metallicity file.
+    Add this line back to each age for each metallicity file, as a single
+    streaming pass: the incoming byte chunks are cut at line boundaries
+    (the partial tail line is carried over to the next chunk), processed,
+    and written straight to 'fout'. Peak memory is one chunk, not the file.
     """
 
-    data = data.split('\n')
-
-    # Indexes of "# Zini" comments
-    idx = []
-    for i, line in enumerate(data):
-        if line.startswith("# Zini"):
-            idx.append(i)
-    # Insert new comments in their proper positions
-    for i, j in enumerate(idx):
-        data.insert(j + i, "# Age = {:.6E} yr".format(ages[i]))
-
-    # Remove label=9 indexes. Addresses #2
-    if rm_label9:
-        idx_9 = []
-        for i, line in enumerate(data):
-            try:
-                if line.split()[9] == '9':
-                    idx_9.append(i)
-            except IndexError:
-                pass
-        data = np.delete(data, idx_9).tolist()
-
-    return "\n".join(data)
+    # Format all the "# Age" comments in one vectorized sweep, instead of
+    # one Python format() call per age block.
+    age_strs = np.char.encode(np.char.mod(
+        "# Age = %.6E yr\n", np.asarray(ages, dtype=np.float64)), 'ascii')
+    ages_it = iter(age_strs)
+
+    def _process(block):
+        # 'block' starts at a line boundary, so the anchored patterns below
+        # see exactly the same line starts as they would on the whole file.
+        if rm_label9:
+            # Remove label=9 lines. Addresses #2
+            block = _LABEL9_RE.sub(b'', block)
+        # Splice the "# Age" comment in right before each header.
+        return _ZINI_RE.sub(lambda m: next(ages_it) + b'# Zini', block)
+
+    tail = b''
+    for chunk in chunks:
+        buf = tail + chunk
+        nl = buf.rfind(b'\n')
+        if nl < 0:
+            tail = buf
+            continue
+        fout.write(_process(buf[:nl + 1]))
+        tail = buf[nl + 1:]
+
+    if tail:
+        fout.write(_process(tail))
 
 
 def readINI():
@@ -332,22 +532,25 @@ def readINI():
         ini_file = Path("params.ini")
     in_params.read(ini_file)
 
-    # Data columns
+    # Data columns. Look each section up once instead of re-hashing the
+    # section name for every parameter.
     gz_flag = in_params['Compress'].getboolean('compress')
-    PARSEC = in_params['Evolutionary tracks'].get('PARSEC')
-    COLIBRI = in_params['Evolutionary tracks'].get('COLIBRI')
-    rm_label9 = in_params['Evolutionary tracks'].getboolean('rm_label9')
-    omegai = in_params['Photometric system'].get('omegai')
-    phot_syst = in_params['Photometric system'].get('phot_syst')
-    phot_syst_v = in_params['Photometric system'].get('YBC_OBC')
-
-    met_sel = in_params['Metallicity / Age ranges'].get('met_selection')
-    age_sel = in_params['Metallicity / Age ranges'].get('age_selection')
-    m_range = in_params['Metallicity / Age ranges'].get('met_range')
-    a_range = in_params['Metallicity / Age ranges'].get('age_range')
-    m_range = list(map(float, m_range.split()))
-    m_range = np.arange(*m_range)
-    a_range = a_range.split()
+
+    tracks = in_params['Evolutionary tracks']
+    PARSEC = tracks.get('PARSEC')
+    COLIBRI = tracks.get('COLIBRI')
+    rm_label9 = tracks.getboolean('rm_label9')
+
+    phot = in_params['Photometric system']
+    omegai = phot.get('omegai')
+    phot_syst = phot.get('phot_syst')
+    phot_syst_v = phot.get('YBC_OBC')
+
+    ranges = in_params['Metallicity / Age ranges']
+    met_sel = ranges.get('met_selection')
+    age_sel = ranges.get('age_selection')
+    m_range = np.arange(*map(float, ranges.get('met_range').split()))
+    a_range = ranges.get('age_range').split()
 
     if PARSEC not in map_models['PARSEC'].keys():
         raise ValueError("Evolutionary track '{}' is invalid".format(